@@ -1,9 +1,15 @@
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, Response, render_template, jsonify, request
+import click
+import csv
 import ee
+import io
 import json
 import plotly
 import plotly.express as px
 import os
+import numpy as np
+import threading
+import time
 from datetime import datetime
 
 app = Flask(__name__)
@@ -14,18 +20,189 @@ ee.Initialize(project='teak-vent-437103-t3')
 # Cache cho dữ liệu
 _cache = {}
 
+# Thời điểm tính, lần dùng gần nhất, hàm tính lại và hàm trả về tuổi tối đa (giây, None nếu không cần làm mới)
+# của từng mục trong cache
+_cache_time = {}
+_cache_access = {}
+_cache_loaders = {}
+_cache_max_age = {}
+_refreshing = set()
+_loading = {}
+_cache_lock = threading.Lock()
+
+# Token của getMapId hết hạn sau vài giờ, làm mới sớm hơn để người dùng không gặp lỗi tile
+MAP_ID_MAX_AGE = 45 * 60
+# Dữ liệu năm hiện tại vẫn đang được bổ sung, các năm trước đã cố định
+CURRENT_YEAR_MAX_AGE = 6 * 3600
+# Chu kỳ kiểm tra cache của luồng làm mới nền
+REFRESH_INTERVAL = 60
+# Làm mới chủ động khi mục đã dùng hết tỷ lệ này của tuổi tối đa
+REFRESH_AHEAD = 0.8
+# Mục cần làm mới nhưng không ai dùng trong khoảng này sẽ bị xóa thay vì làm mới
+IDLE_TIMEOUT = 2 * 3600
+
+def _store(cache_key, value, loader, max_age, accessed=False):
+    # Làm mới ở nền không tính là một lần dùng
+    with _cache_lock:
+        _cache[cache_key] = value
+        _cache_time[cache_key] = time.time()
+        _cache_loaders[cache_key] = loader
+        _cache_max_age[cache_key] = max_age
+        if accessed:
+            _cache_access[cache_key] = _cache_time[cache_key]
+
+def _evict(cache_key):
+    # Gọi khi đang giữ _cache_lock
+    for entries in (_cache, _cache_time, _cache_access, _cache_loaders, _cache_max_age):
+        entries.pop(cache_key, None)
+
+def _refresh(cache_key):
+    try:
+        value = _cache_loaders[cache_key]()
+        _store(cache_key, value, _cache_loaders[cache_key], _cache_max_age[cache_key])
+    except Exception as e:
+        # Giữ lại giá trị cũ, lần kiểm tra sau sẽ thử lại
+        app.logger.warning(f"Không thể làm mới cache {cache_key}: {e}")
+    finally:
+        with _cache_lock:
+            _refreshing.discard(cache_key)
+
+def _schedule_refresh(cache_key):
+    # Gọi khi đang giữ _cache_lock
+    if cache_key in _refreshing:
+        return
+    _refreshing.add(cache_key)
+    threading.Thread(target=_refresh, args=(cache_key,), daemon=True).start()
+
+def _cached(cache_key, loader, max_age=lambda: None):
+    # Trả về ngay giá trị trong cache, nếu đã cũ thì tính lại ở nền
+    while True:
+        with _cache_lock:
+            if cache_key in _cache:
+                _cache_access[cache_key] = time.time()
+                limit = _cache_max_age[cache_key]()
+                if limit is not None and time.time() - _cache_time[cache_key] > limit:
+                    _schedule_refresh(cache_key)
+                return _cache[cache_key]
+            
+            # Nếu đã có luồng khác đang tính mục này thì chờ kết quả của luồng đó
+            loading = _loading.get(cache_key)
+            if loading is None:
+                _loading[cache_key] = threading.Event()
+                break
+        loading.wait()
+    
+    try:
+        value = loader()
+        _store(cache_key, value, loader, max_age, accessed=True)
+    finally:
+        with _cache_lock:
+            _loading.pop(cache_key).set()
+    
+    return value
+
+def _refresh_loop():
+    while True:
+        time.sleep(REFRESH_INTERVAL)
+        now = time.time()
+        try:
+            with _cache_lock:
+                for cache_key in list(_cache):
+                    limit = _cache_max_age[cache_key]()
+                    if limit is None or cache_key in _refreshing:
+                        continue
+                    if now - _cache_access.get(cache_key, now) > IDLE_TIMEOUT:
+                        _evict(cache_key)
+                    elif now - _cache_time[cache_key] > limit * REFRESH_AHEAD:
+                        _schedule_refresh(cache_key)
+        except Exception as e:
+            # Không để luồng nền dừng hẳn, lần kiểm tra sau sẽ thử lại
+            app.logger.warning(f"Lỗi khi kiểm tra cache: {e}")
+
+# Collection và band của từng loại khí
+GASES = {
+    'CO': ('COPERNICUS/S5P/OFFL/L3_CO', 'CO_column_number_density'),
+    'NO2': ('COPERNICUS/S5P/OFFL/L3_NO2', 'tropospheric_NO2_column_number_density'),
+    'HCHO': ('COPERNICUS/S5P/OFFL/L3_HCHO', 'tropospheric_HCHO_column_number_density'),
+}
+MONTHS = np.arange(1, 13)
+# Năm đầu tiên có dữ liệu Sentinel-5P đầy đủ
+FIRST_YEAR = 2019
+
+def available_years():
+    return list(range(FIRST_YEAR, datetime.now().year + 1))
+
+# Asset ranh giới của các khu vực phân tích
+BOUNDARIES = {
+    'tanbinh': 'projects/teak-vent-437103-t3/assets/tanbinh',
+}
+
+# Trung bình theo tháng của mỗi (khu vực, loại khí) lưu trong một mảng (năm x 12 tháng), NaN khi không có dữ liệu.
+# _cache chỉ giữ chỉ số dòng của năm trong mảng tương ứng.
+_series_values = {}
+_series_rows = {}
+
+def _series_put(series_key, year, values):
+    with _cache_lock:
+        rows = _series_rows.setdefault(series_key, {})
+        if year not in rows:
+            table = _series_values.setdefault(series_key, np.full((0, 12), np.nan))
+            if len(rows) == len(table):
+                # Nhân đôi sức chứa để không phải sao chép mảng mỗi khi thêm năm
+                grown = np.full((max(2 * len(table), 4), 12), np.nan)
+                grown[:len(table)] = table
+                _series_values[series_key] = grown
+            rows[year] = len(rows)
+        _series_values[series_key][rows[year]] = values
+        return rows[year]
+
+def _series_get(series_key, years):
+    with _cache_lock:
+        return _series_values[series_key][[_series_rows[series_key][year] for year in years]]
+
+def cache_memory_usage():
+    # Dung lượng (byte) của dữ liệu đang giữ trong bộ nhớ
+    with _cache_lock:
+        series = {}
+        for (boundary, gas), table in _series_values.items():
+            rows = len(_series_rows[(boundary, gas)])
+            series[f"{boundary}/{gas}"] = {
+                'rows': rows,
+                'capacity': len(table),
+                'bytes_used': rows * table.itemsize * table.shape[1],
+                'bytes_allocated': table.nbytes
+            }
+        
+        # Mục data_{year} chỉ giữ đối tượng ee (biểu thức chưa tính) và map ID nên chỉ đếm số lượng
+        return {
+            'series': series,
+            'boundary_geojson_bytes': {key[len('geojson_'):]: len(json.dumps(value))
+                                       for key, value in _cache.items() if key.startswith('geojson_')},
+            'map_entries': sum(1 for key in _cache if key.startswith('data_')),
+            'entries': len(_cache)
+        }
+
+def _to_json_values(values):
+    # NaN không hợp lệ trong JSON, chuyển thành null
+    return np.where(np.isnan(values), None, values).tolist()
+
+def _monthly_max_age(year):
+    # Chỉ năm hiện tại (và năm chưa tới) mới có dữ liệu thay đổi, kiểm tra mỗi lần dùng
+    # để mục của năm cũ ngừng làm mới sau khi sang năm mới
+    return CURRENT_YEAR_MAX_AGE if year >= datetime.now().year else None
+
 def load_data(year=2023):
-    # Kiểm tra nếu đã có trong cache
     cache_key = f"data_{year}"
-    if cache_key in _cache:
-        return _cache[cache_key]
-    
+    # Map ID cần làm mới ở mọi năm vì token hết hạn
+    return _cached(cache_key, lambda: _compute_data(year), lambda: MAP_ID_MAX_AGE)
+
+def _compute_data(year):
     # Tạo khoảng thời gian cho năm được chọn
     start_date = f"{year}-01-01"
     end_date = f"{year}-12-31"
     
     # Tải FeatureCollection tanbinh và chỉ lấy hình học để giảm kích thước
-    tanbinh = ee.FeatureCollection("projects/teak-vent-437103-t3/assets/tanbinh").geometry()
+    tanbinh = boundary_geometry('tanbinh')
     
     # Load CO data
     ST5_CO = ee.ImageCollection('COPERNICUS/S5P/OFFL/L3_CO')
@@ -66,7 +243,6 @@ def load_data(year=2023):
         'palette': ['black', 'blue', 'purple', 'cyan', 'green', 'yellow', 'red']
     })
     
-    # Cache lại dữ liệu
     data = {
         'tanbinh': tanbinh,
         'map_id_dict_CO': map_id_dict_CO,
@@ -74,10 +250,8 @@ def load_data(year=2023):
         'map_id_dict_NO2': map_id_dict_NO2,
         'image_NO2': image_NO2,
         'map_id_dict_HCHO': map_id_dict_HCHO,
-        'image_HCHO': image_HCHO,
-        'tanbinh_geojson': tanbinh.getInfo()
+        'image_HCHO': image_HCHO
     }
-    _cache[cache_key] = data
     
     return data
 
@@ -127,12 +301,26 @@ def analyze_region(geojson_str, data):
     
     return mean_co_value, mean_no2_value, mean_hcho_value
 
-def monthly_mean(year, collection_name, band_name, _geometry):
-    # Kiểm tra nếu đã có trong cache
-    cache_key = f"{year}_{collection_name}_{band_name}"
-    if cache_key in _cache:
-        return _cache[cache_key]
+def boundary_geometry(boundary):
+    return ee.FeatureCollection(BOUNDARIES[boundary]).geometry()
+
+def boundary_geojson(boundary):
+    # Ranh giới không đổi theo năm nên chỉ lưu một bản GeoJSON cho mỗi khu vực
+    return _cached(f"geojson_{boundary}", lambda: boundary_geometry(boundary).getInfo())
+
+def monthly_means(years, gas, boundary='tanbinh'):
+    # Trả về mảng (số năm x 12 tháng) cho loại khí, tính những năm chưa có trong cache
+    series_key = (boundary, gas)
+    for year in years:
+        _cached(f"{year}_{boundary}_{gas}",
+                lambda year=year: _series_put(series_key, year,
+                                              _compute_monthly_mean(year, gas, boundary_geometry(boundary))),
+                lambda year=year: _monthly_max_age(year))
     
+    return _series_get(series_key, years)
+
+def _compute_monthly_mean(year, gas, _geometry):
+    collection_name, band_name = GASES[gas]
     months = ee.List.sequence(1, 12)
     collection = ee.ImageCollection(collection_name)
 
@@ -150,10 +338,14 @@ def monthly_mean(year, collection_name, band_name, _geometry):
                         ).get(band_name)
     }))).getInfo()
     
-    # Cache lại dữ liệu
-    _cache[cache_key] = result
+    # Chỉ giữ giá trị trung bình theo thứ tự tháng
+    values = np.full(12, np.nan)
+    for feature in result['features']:
+        mean = feature['properties']['mean']
+        if mean is not None:
+            values[int(feature['properties']['month']) - 1] = mean
     
-    return result
+    return values
 
 @app.route('/')
 def index():
@@ -161,8 +353,7 @@ def index():
     year = request.args.get('year', default=2023, type=int)
     
     # Tạo danh sách các năm có sẵn
-    current_year = datetime.now().year
-    available_years = list(range(2019, current_year + 1))
+    years = available_years()
     
     # Tải dữ liệu cho năm được chọn
     data = load_data(year)
@@ -174,11 +365,11 @@ def index():
         'co_tiles': data['map_id_dict_CO']['tile_fetcher'].url_format,
         'no2_tiles': data['map_id_dict_NO2']['tile_fetcher'].url_format,
         'hcho_tiles': data['map_id_dict_HCHO']['tile_fetcher'].url_format,
-        'tanbinh_geojson': data['tanbinh_geojson'],
+        'tanbinh_geojson': boundary_geojson('tanbinh'),
         'selected_year': year
     }
     
-    return render_template('index.html', mapData=mapData, available_years=available_years)
+    return render_template('index.html', mapData=mapData, available_years=years)
 
 @app.route('/api/point_data', methods=['POST'])
 def point_data_api():
@@ -224,19 +415,11 @@ def monthly_data_api():
     # Lấy năm từ request
     year = request.args.get('year', default=2023, type=int)
     
-    # Tải dữ liệu cho năm được chọn
-    data = load_data(year)
-    
     # Lấy dữ liệu theo tháng
-    monthly_means_co = monthly_mean(year, 'COPERNICUS/S5P/OFFL/L3_CO', 'CO_column_number_density', data['tanbinh'])
-    monthly_means_no2 = monthly_mean(year, 'COPERNICUS/S5P/OFFL/L3_NO2', 'tropospheric_NO2_column_number_density', data['tanbinh'])
-    monthly_means_hcho = monthly_mean(year, 'COPERNICUS/S5P/OFFL/L3_HCHO', 'tropospheric_HCHO_column_number_density', data['tanbinh'])
-    
-    # Xử lý dữ liệu cho biểu đồ
-    months = [feature['properties']['month'] for feature in monthly_means_co['features']]
-    co_values = [feature['properties']['mean'] for feature in monthly_means_co['features']]
-    no2_values = [feature['properties']['mean'] for feature in monthly_means_no2['features']]
-    hcho_values = [feature['properties']['mean'] for feature in monthly_means_hcho['features']]
+    months = MONTHS.tolist()
+    co_values = _to_json_values(monthly_means([year], 'CO')[0])
+    no2_values = _to_json_values(monthly_means([year], 'NO2')[0])
+    hcho_values = _to_json_values(monthly_means([year], 'HCHO')[0])
     
     # Tạo biểu đồ với plotly
     fig_co = px.line(x=months, y=co_values, 
@@ -270,42 +453,23 @@ def comparison_data_api():
     if not years:
         years = [2023]  # Mặc định là năm 2023
     
-    # Tải dữ liệu tanbinh
-    data = load_data(years[0])
-    tanbinh = data['tanbinh']
+    # Mảng (số năm x 12 tháng) cho loại khí được chọn, mặc định là HCHO
+    values = monthly_means(years, gas_type if gas_type in GASES else 'HCHO')
     
     # Dữ liệu cho biểu đồ so sánh
-    comparison_data = []
-    
-    for year in years:
-        if gas_type == "CO":
-            monthly_data = monthly_mean(year, 'COPERNICUS/S5P/OFFL/L3_CO', 'CO_column_number_density', tanbinh)
-            for feature in monthly_data['features']:
-                comparison_data.append({
-                    "year": str(year),
-                    "month": feature['properties']['month'],
-                    "value": feature['properties']['mean']
-                })
-        elif gas_type == "NO2":
-            monthly_data = monthly_mean(year, 'COPERNICUS/S5P/OFFL/L3_NO2', 'tropospheric_NO2_column_number_density', tanbinh)
-            for feature in monthly_data['features']:
-                comparison_data.append({
-                    "year": str(year),
-                    "month": feature['properties']['month'],
-                    "value": feature['properties']['mean']
-                })
-        else:  # HCHO
-            monthly_data = monthly_mean(year, 'COPERNICUS/S5P/OFFL/L3_HCHO', 'tropospheric_HCHO_column_number_density', tanbinh)
-            for feature in monthly_data['features']:
-                comparison_data.append({
-                    "year": str(year),
-                    "month": feature['properties']['month'],
-                    "value": feature['properties']['mean']
-                })
+    comparison_data = [
+        {"year": str(year), "month": month, "value": value}
+        for year, row in zip(years, values)
+        for month, value in zip(MONTHS.tolist(), _to_json_values(row))
+    ]
     
     # Tạo biểu đồ so sánh với plotly
     import pandas as pd
-    df = pd.DataFrame(comparison_data)
+    df = pd.DataFrame({
+        "year": np.repeat([str(year) for year in years], len(MONTHS)),
+        "month": np.tile(MONTHS, len(years)),
+        "value": values.ravel()
+    })
     
     fig_comparison = px.line(
         df, 
@@ -325,6 +489,167 @@ def comparison_data_api():
         'comparison_data': comparison_data
     })
 
+# Cột của file xuất theo tần suất thống kê
+EXPORT_COLUMNS = {
+    'monthly': ['boundary', 'gas', 'year', 'month', 'value'],
+    'annual': ['boundary', 'gas', 'year', 'value'],
+}
+EXPORT_MIMETYPES = {
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet',
+}
+# Số dòng gom lại trước khi gửi một phần dữ liệu (một row group với Parquet)
+EXPORT_CHUNK_ROWS = 1000
+
+def prepare_export(years, gases, boundaries):
+    # Tính trước mọi năm còn thiếu để lỗi Earth Engine xảy ra trước khi bắt đầu gửi file
+    for boundary in boundaries:
+        for gas in gases:
+            monthly_means(years, gas, boundary)
+
+def export_rows(years, gases, boundaries, freq='monthly'):
+    # Sinh từng dòng thống kê từ mảng đã có trong cache (cần gọi prepare_export trước)
+    for boundary in boundaries:
+        for gas in gases:
+            values = _series_get((boundary, gas), years)
+            if freq == 'annual':
+                # Trung bình các tháng có dữ liệu, NaN nếu cả năm không có dữ liệu
+                counts = np.count_nonzero(~np.isnan(values), axis=1)
+                annual = np.where(counts > 0, np.nansum(values, axis=1) / np.maximum(counts, 1), np.nan)
+                for year, value in zip(years, _to_json_values(annual)):
+                    yield (boundary, gas, year, value)
+            else:
+                for year, row in zip(years, values):
+                    for month, value in zip(MONTHS.tolist(), _to_json_values(row)):
+                        yield (boundary, gas, year, month, value)
+
+def _export_csv(rows, columns):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for i, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if i % EXPORT_CHUNK_ROWS == 0:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+class _ChunkSink(io.RawIOBase):
+    # File chỉ ghi, giữ các byte đã ghi cho tới khi được lấy ra để gửi đi
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+    
+    def writable(self):
+        return True
+    
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+    
+    def tell(self):
+        return self._position
+    
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def _export_parquet(rows, columns):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    
+    types = {'boundary': pa.string(), 'gas': pa.string(), 'year': pa.int32(),
+             'month': pa.int8(), 'value': pa.float64()}
+    schema = pa.schema([(column, types[column]) for column in columns])
+    
+    def to_table(batch):
+        return pa.Table.from_arrays([pa.array(values, type=field.type)
+                                     for values, field in zip(zip(*batch), schema)],
+                                    schema=schema)
+    
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == EXPORT_CHUNK_ROWS:
+            writer.write_table(to_table(batch))
+            batch = []
+            yield sink.drain()
+    if batch:
+        writer.write_table(to_table(batch))
+    writer.close()
+    yield sink.drain()
+
+def export_stream(years, gases, boundaries, freq='monthly', fmt='csv'):
+    columns = EXPORT_COLUMNS[freq]
+    rows = export_rows(years, gases, boundaries, freq)
+    if fmt == 'parquet':
+        return _export_parquet(rows, columns)
+    return _export_csv(rows, columns)
+
+@app.route('/api/export')
+def export_api():
+    # Lấy các năm, loại khí, khu vực và định dạng cần xuất
+    raw_years = request.args.getlist('years[]')
+    gases = request.args.getlist('gases[]') or list(GASES)
+    boundaries = request.args.getlist('boundaries[]') or list(BOUNDARIES)
+    freq = request.args.get('freq', default='monthly')
+    fmt = request.args.get('format', default='csv')
+    
+    if (not set(gases) <= set(GASES) or not set(boundaries) <= set(BOUNDARIES)
+            or freq not in EXPORT_COLUMNS or fmt not in EXPORT_MIMETYPES):
+        return jsonify({'error': 'Tham số không hợp lệ'}), 400
+    
+    # Chỉ nhận các năm có trong danh sách năm có sẵn
+    if not raw_years:
+        years = available_years()
+    elif all(value.isdigit() and int(value) in available_years() for value in raw_years):
+        years = [int(value) for value in raw_years]
+    else:
+        return jsonify({'error': f'Năm phải nằm trong khoảng {FIRST_YEAR}-{datetime.now().year}'}), 400
+    
+    try:
+        prepare_export(years, gases, boundaries)
+    except ee.EEException as e:
+        return jsonify({'error': f'Không thể lấy dữ liệu từ Google Earth Engine: {e}'}), 502
+    
+    return Response(export_stream(years, gases, boundaries, freq, fmt),
+                    mimetype=EXPORT_MIMETYPES[fmt],
+                    headers={'Content-Disposition': f'attachment; filename=air_quality_{freq}.{fmt}'})
+
+@app.cli.command('export')
+@click.option('--year', 'years', type=click.IntRange(FIRST_YEAR, datetime.now().year), multiple=True, required=True,
+              help='Năm cần xuất, có thể lặp lại.')
+@click.option('--gas', 'gases', type=click.Choice(list(GASES)), multiple=True, help='Mặc định là tất cả loại khí.')
+@click.option('--boundary', 'boundaries', type=click.Choice(list(BOUNDARIES)), multiple=True,
+              help='Mặc định là tất cả khu vực.')
+@click.option('--freq', type=click.Choice(list(EXPORT_COLUMNS)), default='monthly')
+@click.option('--format', 'fmt', type=click.Choice(list(EXPORT_MIMETYPES)), default='csv')
+@click.option('--output', '-o', type=click.File('wb'), default='-', help='Mặc định là stdout.')
+def export_command(years, gases, boundaries, freq, fmt, output):
+    """Xuất thống kê nồng độ khí theo tháng hoặc theo năm ra CSV/Parquet."""
+    years = list(years)
+    gases = list(gases) or list(GASES)
+    boundaries = list(boundaries) or list(BOUNDARIES)
+    try:
+        prepare_export(years, gases, boundaries)
+    except ee.EEException as e:
+        raise click.ClickException(f'Không thể lấy dữ liệu từ Google Earth Engine: {e}')
+    
+    for chunk in export_stream(years, gases, boundaries, freq, fmt):
+        output.write(chunk)
+
+@app.route('/api/cache_stats')
+def cache_stats_api():
+    return jsonify(cache_memory_usage())
+
+# Luồng nền làm mới map ID và dữ liệu năm hiện tại trước khi hết hạn
+threading.Thread(target=_refresh_loop, daemon=True).start()
+
 if __name__ == '__main__':
     # Tạo thư mục templates nếu chưa có
     if not os.path.exists('templates'):